@@ -1,25 +1,40 @@
 # Author: Robert Leskovar (robert.leskovar@gmail.com), 2023
 # Main Dash app
 
-import base64
+import uuid
 import dash.exceptions
 from dotenv import load_dotenv
 import os
 import io
 import openai
+import orjson
 import re
+import flask
+from flask.json.provider import DefaultJSONProvider
 from dash import Dash, dcc, html, Input, Output, State, ctx, DiskcacheManager, clientside_callback, ClientsideFunction
 import dash_bootstrap_components as dbc
-from utils.consts import AI_ROLE_OPTIONS_EN, AI_SUMMARIZATION_TYPE
-from utils.openai_mgmt import openai_completion
-from utils.text_extract_summarize import retrieve_pdf_from_response, extract_text_from_pdf, \
-    process_text, page_to_string, get_content_from_url
+from utils.consts import AI_ROLE_OPTIONS_EN, AI_SUMMARIZATION_TYPE, OUTPUT_PREFIXES
+from utils.openai_mgmt import openai_completion, run_async
+from utils.text_extract_summarize import retrieve_pdf_from_response, iter_pdf_pages, WordCountingPages, \
+    process_text, page_to_string, get_content_from_url, MAX_DOWNLOAD_SIZE
+from utils.cache import cache
 from dash_auth import BasicAuth
-import diskcache
 
-# cache is required for a long-running call to OpenAI's API
-cache = diskcache.Cache("./cache")
-background_callback_manager = DiskcacheManager(cache)
+load_dotenv()
+# set at import, so that also background callback workers (e.g. Celery) have the key
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# With REDIS_URL set (e.g. deployment with multiple workers), long-running callbacks are run by Celery workers
+# (start them with `celery -A app:celery_app worker`), otherwise in local processes managed via disk cache.
+if os.getenv("REDIS_URL"):
+    from celery import Celery
+    from dash import CeleryManager
+
+    celery_app = Celery(__name__, broker=os.getenv("REDIS_URL"), backend=os.getenv("REDIS_URL"))
+    background_callback_manager = CeleryManager(celery_app)
+else:
+    # cache is required for a long-running call to OpenAI's API
+    background_callback_manager = DiskcacheManager(cache)
 
 # OpenAI's model to use for discussion and summarization via API. Recommended are gpt-4 or gpt-3.5-turbo
 LLM_MODEL = "gpt-4"
@@ -29,6 +44,27 @@ LLM_MODEL = "gpt-4"
 # Use a lower value than the limit.
 MAX_TOKENS_PER_CHUNK = 7000
 
+# Chunks of a document/web page are summarized concurrently. Limit the number of simultaneous requests and
+# throttle them to the OpenAI's rate limits of your account (gpt-4 default is 200 requests and 40000 tokens
+# per minute, as of June 2023).
+MAX_CONCURRENT_REQUESTS = 8
+MAX_REQUESTS_PER_MINUTE = 200
+MAX_TOKENS_PER_MINUTE = 40000
+
+# Words in AI personality which add instructions to the system prompt
+# (matched anywhere in the personality, e.g. "mathematician" or "schoolteacher" - "math" covers "maths" too)
+SCIENCE_KEYWORDS_PATTERN = re.compile(r'school|physics|math')
+PROOFREADER_KEYWORDS_PATTERN = re.compile(r'proofreader')
+
+# Regex pattern to find LaTeX content beginning and ending with $$
+LATEX_BLOCK_PATTERN = re.compile(r'\$\$.*?\$\$', re.DOTALL)
+
+# uploaded PDF files are kept in cache for an hour (seconds)
+UPLOAD_EXPIRE = 60 * 60
+# accepted uploads - content types sent by browsers for PDF files (empty if unknown) and the PDF file header
+PDF_MIMETYPES = ('application/pdf', 'application/x-pdf', 'application/octet-stream', '')
+PDF_HEADER = b'%PDF-'
+
 DEFAULT_UPLOAD_CONTENT = [
     'Drag and Drop or ',
     html.B('Select Files')
@@ -41,9 +77,9 @@ def get_system_prompt(sys_prompt, ai_custom_role):
     else:
         system_prompt = f"You are {sys_prompt}."
 
-    if any(subs in system_prompt for subs in ["school", "physics", "math", "maths", "mathematics"]):
+    if SCIENCE_KEYWORDS_PATTERN.search(system_prompt):
         system_prompt = system_prompt + " If you answer with equations, write them as separate blocks in LaTeX and delimit them with $$."
-    elif any(subs in sys_prompt for subs in ["proofreader"]):
+    elif PROOFREADER_KEYWORDS_PATTERN.search(system_prompt):
         system_prompt += " Proofread and correct this text: "
 
     return system_prompt
@@ -142,7 +178,8 @@ def main_UI():
                 ], width=2),  # end col 1
                 dbc.Col([
                     html.H5('Load PDF Document:'),
-                    dcc.Upload(
+                    # file is selected or dropped here and uploaded to the server by assets/upload.js
+                    html.Div(
                         id='upload-pdf',
                         children=html.Div(DEFAULT_UPLOAD_CONTENT),
                         style={
@@ -153,9 +190,9 @@ def main_UI():
                             'borderStyle': 'dashed',
                             'borderRadius': '5px',
                             'textAlign': 'center',
-                            'margin': '10px'
+                            'margin': '10px',
+                            'cursor': 'pointer',
                         },
-                        multiple=False
                     ),
                 ], width=6),  # end col 2
                 dbc.Col([
@@ -204,6 +241,11 @@ def main_UI():
                                className="me-2",
                                n_clicks=0,
                                disabled=False),
+                    dbc.Checkbox(id='summ-batch',
+                                 label='Use batch mode (cheaper, slower)',
+                                 value=False,
+                                 class_name='d-inline-block',
+                                 ),
                 ]),  # end col 2
             ]),  # end row 2
         ])  # end div
@@ -237,12 +279,73 @@ def output_UI():
     ])
 
 
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider using orjson (C implementation) to parse callback requests with the stores
+    (conversation history, outputs) and to serialize JSON responses.
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        orjson_kwargs = dict(kwargs)
+        if orjson_kwargs.pop('sort_keys', False):
+            option |= orjson.OPT_SORT_KEYS
+        if orjson_kwargs.get('indent') == 2:  # the only indentation of orjson
+            del orjson_kwargs['indent']
+            option |= orjson.OPT_INDENT_2
+        elif orjson_kwargs.get('indent') is None:
+            orjson_kwargs.pop('indent', None)
+        # compact separators are the orjson output
+        if orjson_kwargs.get('separators') == (',', ':'):
+            del orjson_kwargs['separators']
+        if orjson_kwargs:
+            # other arguments of the json module
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 # instantiate dash
 app = Dash(__name__,
            external_stylesheets=[dbc.themes.CERULEAN, r"./assets/styles.css"],
            )  # create layout
 
 server = app.server
+server.json = OrjsonProvider(server)
+# uploaded files are limited to the same size as downloaded documents, larger requests are rejected (413)
+server.config['MAX_CONTENT_LENGTH'] = MAX_DOWNLOAD_SIZE
+
+
+@server.route('/upload', methods=['POST'])
+def upload_pdf():
+    """
+    Receive an uploaded PDF file (multipart/form-data) and store it in cache.
+    The file is passed to the summarization by its id, so it doesn't travel through the browser store.
+    return: id of the stored file
+    """
+    pdf_file = flask.request.files.get('pdf')
+    if pdf_file is None:
+        return 'No file uploaded.', 400
+
+    pdf_bytes = pdf_file.read()
+    # PDF header (%PDF-) must be within the first 1024 bytes of the file
+    if pdf_file.mimetype not in PDF_MIMETYPES or PDF_HEADER not in pdf_bytes[:1024]:
+        return 'Only PDF files can be uploaded.', 415
+
+    uid = uuid.uuid4().hex
+    cache.set(f'upload-{uid}', pdf_bytes, expire=UPLOAD_EXPIRE)
+    return uid
+
+
+@server.errorhandler(413)
+def upload_too_large(e):
+    """
+    Plain text error for requests larger than MAX_CONTENT_LENGTH, shown to the user by assets/upload.js.
+    """
+    return f'File is too large, max size is {MAX_DOWNLOAD_SIZE} bytes.', 413
+
 
 app.title = 'GPT Chat and Summarization Assistant'
 
@@ -270,12 +373,28 @@ app.layout = html.Div([
         dcc.Store(id='history'),  # store history of conversation
         dcc.Store(id='outputs'),  # store history of outputs
         dcc.Store(id='summ-outputs'),  # store history of summarization outputs
+        dcc.Store(id='pdf-upload'),  # id and filename of the uploaded PDF file
     ])  # end container
 ])  # end div
 
 
-@app.callback(
+# outputs are stored as {"role": ..., "text": ...} items and rendered on the client side (assets/render.js)
+clientside_callback(
+    ClientsideFunction(namespace='ui', function_name='renderOutputs'),
+    Output('text-output', 'children', allow_duplicate=True),
+    Input('outputs', 'data'),
+    prevent_initial_call=True,
+)
+
+clientside_callback(
+    ClientsideFunction(namespace='ui', function_name='renderOutputs'),
     Output('text-output', 'children', allow_duplicate=True),
+    Input('summ-outputs', 'data'),
+    prevent_initial_call=True,
+)
+
+
+@app.callback(
     Output('user-text-input', 'value', allow_duplicate=True),
     Output('history', 'data', allow_duplicate=True),
     Output('outputs', 'data', allow_duplicate=True),
@@ -291,7 +410,7 @@ def update_clear_button(clear_button_clicks):
 
     trigger_id = ctx.triggered_id
     if 'clear-button' in trigger_id:
-        return None, None, [], []
+        return None, [], []
 
 
 def fix_latex(output_text):
@@ -299,20 +418,8 @@ def fix_latex(output_text):
     Check if output_text contains latex content that begins and ends with $$.
     If it does, enclose with newlines every such instance so that it gets render properly.
     """
-
-    def enclose_with_html(match):
-        """
-        Enclose found LaTeX content with newlines
-        """
-        latex_content = match.group()[:]
-        return f'\n{latex_content}\n'
-
-    # Regex pattern to find LaTeX content beginning and ending with $$
-    pattern = re.compile(r'\$\$.*?\$\$', re.DOTALL)
-
-    # Apply enclosing to all matches in the output_text
-    output_text = pattern.sub(enclose_with_html, output_text)
-    return output_text
+    # Apply enclosing with newlines to all found LaTeX contents
+    return LATEX_BLOCK_PATTERN.sub(lambda match: f'\n{match.group()}\n', output_text)
 
 
 @app.callback(
@@ -369,8 +476,9 @@ def update_answer_output(prompt_button_clicks, history, outputs, sys_prompt, ai_
         # print(input_text)
         if input_text is None or len(input_text) == 0:
             output_text = 'Please enter a prompt.'
+            # outputs are not updated, so that the message is not replaced by rendered outputs
             return html.Div(), dcc.Markdown(output_text, style={'white-space': 'pre-wrap'}), input_text, \
-                history, outputs
+                history, dash.no_update
         else:
             # add user prompt to history and output
             history.append({"role": "user", "content": input_text})
@@ -388,28 +496,23 @@ def update_answer_output(prompt_button_clicks, history, outputs, sys_prompt, ai_
 
             print(f'AI response:\n{output_text}')
 
-            # add output to outputs
-            outputs.insert(0, dcc.Markdown('🤖: ' + output_text,
-                                           mathjax=True,  # allows for LaTeX formatting
-                                           style={'white-space': 'pre-wrap'}))  # keep white space and breaks, wrap
+            # add output to outputs, they are rendered on the client side
+            outputs.insert(0, {"role": "assistant", "text": output_text})
             # add user input to outputs
-            outputs.insert(0, dcc.Markdown('\n🙂: ' + input_text, style={'white-space': 'pre-wrap'}))
+            outputs.insert(0, {"role": "user", "text": input_text})
 
             # if there was API error, don't clear input text
             if api_error:
-                return html.Div(), outputs, input_text, history, outputs
+                return html.Div(), dash.no_update, input_text, history, outputs
             else:  # otherwise, clear input text
-                return html.Div(), outputs, "", history, outputs
+                return html.Div(), dash.no_update, "", history, outputs
 
 
 def history_to_str(outputs):
-    history_str = ""
-    # print(outputs)
-    for item in outputs:
-        # print(item)
-        history_str += item.get('props').get('children') + '\n'
-
-    return history_str
+    """
+    Join outputs (discussion or summary) into a text for download, each output on its own line.
+    """
+    return "".join(OUTPUT_PREFIXES[item['role']] + item['text'] + '\n' for item in outputs)
 
 
 @app.callback(
@@ -475,18 +578,17 @@ def update_summ_download(n_clicks, summ_outputs):
 
 @app.callback(
     Output('loading-div', 'children', allow_duplicate=True),
-    Output('text-output', 'children', allow_duplicate=True),
     Output('summ-outputs', 'data', allow_duplicate=True),
 
     Input('summ-button', 'n_clicks'),
 
-    State('upload-pdf', 'contents'),
-    State('upload-pdf', 'filename'),
+    State('pdf-upload', 'data'),
     State('url-input', 'value'),
     State('summ-percent', 'value'),
     State('summ-type', 'value'),
     State('summ-question', 'value'),
     State('randomness', 'value'),
+    State('summ-batch', 'value'),
     State('summ-outputs', 'data'),
 
     running=[
@@ -499,8 +601,8 @@ def update_summ_download(n_clicks, summ_outputs):
     prevent_initial_call=True,
 )
 def update_summarize_output(summ_button_clicks,
-                            uploaded_pdf_contents, pdf_filename, url_input, summ_percentage, summ_type, summ_question,
-                            randomness, summ_outputs):
+                            pdf_upload, url_input, summ_percentage, summ_type, summ_question,
+                            randomness, batch_mode, summ_outputs):
     """
     Callback to summarize the text.
     """
@@ -539,7 +641,8 @@ def update_summarize_output(summ_button_clicks,
                         output_string = f'{e}'
                     else:
                         if pdf_object is not None:
-                            url_text, num_words = extract_text_from_pdf(pdf_object)
+                            # pages are extracted while the already extracted text is being summarized
+                            url_text = WordCountingPages(iter_pdf_pages(pdf_object))
                         else:
                             output_string = f'Could not extract text from PDF at {url_input}'
                 elif 'text/html' in content_type:
@@ -547,21 +650,31 @@ def update_summarize_output(summ_button_clicks,
                         url_text, num_words = page_to_string(response, content_type)
                     except Exception as e:
                         output_string = f'{e}'
+                else:
+                    # unsupported content is not read, release the connection
+                    response.close()
 
-                if url_text is not None and len(url_text) > 0:
+                if isinstance(url_text, WordCountingPages) or (url_text is not None and len(url_text) > 0):
                     try:
-                        summary = process_text(content_text=url_text,
-                                               summarize_type=summ_type,
-                                               question=summ_question,
-                                               llm_model=LLM_MODEL,
-                                               tokens_limit=MAX_TOKENS_PER_CHUNK,
-                                               length_percentage=summ_percentage,
-                                               randomness=randomness)
+                        summary = run_async(process_text(content_text=url_text,
+                                                         summarize_type=summ_type,
+                                                         question=summ_question,
+                                                         llm_model=LLM_MODEL,
+                                                         tokens_limit=MAX_TOKENS_PER_CHUNK,
+                                                         length_percentage=summ_percentage,
+                                                         randomness=randomness,
+                                                         max_concurrency=MAX_CONCURRENT_REQUESTS,
+                                                         max_requests_per_minute=MAX_REQUESTS_PER_MINUTE,
+                                                         max_tokens_per_minute=MAX_TOKENS_PER_MINUTE,
+                                                         batch_mode=bool(batch_mode)))
                     except openai.error.OpenAIError as e:
                         output_string = f"OpenAI API error: {e}"
                     except ValueError as e:
                         output_string = f"Error: {e}"
                     else:
+                        if isinstance(url_text, WordCountingPages):
+                            num_words = url_text.num_words
+
                         if summ_type == AI_SUMMARIZATION_TYPE["FOCUS_QUESTION"]:
                             output_string = f'Summary of the content at {url_input} with {num_words} words to max ' \
                                             f'{summ_percentage}%, focusing on the question "{summ_question}":\n\n{summary}'
@@ -570,28 +683,33 @@ def update_summarize_output(summ_button_clicks,
                                             f'{summ_percentage}%:\n\n{summary}'
 
         # if URL input field is empty, check if PDF is uploaded
-        elif uploaded_pdf_contents is not None:
-            content_type, content_string = uploaded_pdf_contents.split(',')
-
-            print(f'{content_type=}')
-            print(f'{content_string[:100]=}')
+        elif pdf_upload is not None:
+            pdf_filename = pdf_upload['filename']
 
             try:
-                pdf_object = base64.b64decode(content_string)
-                pdf_object = io.BytesIO(pdf_object)
+                pdf_bytes = cache.get(f"upload-{pdf_upload['uid']}")
+                if pdf_bytes is None:
+                    raise ValueError('the uploaded file has expired, please upload it again')
+                pdf_object = io.BytesIO(pdf_bytes)
 
                 if 'pdf' in pdf_filename.lower():
-                    pdf_text, num_words = extract_text_from_pdf(pdf_object)
+                    # pages are extracted while the already extracted text is being summarized
+                    pdf_pages = WordCountingPages(iter_pdf_pages(pdf_object))
                     try:
-                        summary = process_text(content_text=pdf_text,
-                                               summarize_type=summ_type,
-                                               question=summ_question,
-                                               llm_model=LLM_MODEL,
-                                               tokens_limit=MAX_TOKENS_PER_CHUNK,
-                                               length_percentage=summ_percentage,
-                                               randomness=randomness)
+                        summary = run_async(process_text(content_text=pdf_pages,
+                                                         summarize_type=summ_type,
+                                                         question=summ_question,
+                                                         llm_model=LLM_MODEL,
+                                                         tokens_limit=MAX_TOKENS_PER_CHUNK,
+                                                         length_percentage=summ_percentage,
+                                                         randomness=randomness,
+                                                         max_concurrency=MAX_CONCURRENT_REQUESTS,
+                                                         max_requests_per_minute=MAX_REQUESTS_PER_MINUTE,
+                                                         max_tokens_per_minute=MAX_TOKENS_PER_MINUTE,
+                                                         batch_mode=bool(batch_mode)))
                     except openai.error.OpenAIError as e:
                         output_string = f"OpenAI API error: {e}"
+                    num_words = pdf_pages.num_words
             except Exception as e:
                 output_string = f'Error processing file {pdf_filename}: {e}'
                 print(output_string)
@@ -605,34 +723,29 @@ def update_summarize_output(summ_button_clicks,
         else:
             output_string = 'Please enter a valid URL or upload a PDF.'
 
-        # allows for LaTeX formatting and keep white space and breaks, wrap
-        summ_outputs.append(dcc.Markdown('🤖: ' + output_string,
-                                         mathjax=True,
-                                         style={'white-space': 'pre-wrap'}))
+        # summary is rendered on the client side
+        summ_outputs.append({"role": "assistant", "text": output_string})
 
-        return html.Div(), summ_outputs, summ_outputs
+        return html.Div(), summ_outputs
 
 
 @app.callback(
     Output('upload-pdf', 'children'),
 
-    Input('upload-pdf', 'filename'),
+    Input('pdf-upload', 'data'),
 
     prevent_initial_call=True,
 )
-def update_upload_pdf(filename: str):
+def update_upload_pdf(pdf_upload: dict):
     """
-    Callback to upload a PDF file.
+    Callback to show the name of the uploaded PDF file.
     """
 
     upload_text = DEFAULT_UPLOAD_CONTENT.copy()
-    upload_text.append(f" ({filename})")
+    upload_text.append(f" ({pdf_upload['filename']})")
     return upload_text
 
 
 # run app server
 if __name__ == '__main__':
-    load_dotenv()
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-
     app.run_server(debug=True)
@@ -0,0 +1,30 @@
+// Client-side rendering of outputs (discussion and summaries) stored as {"role": ..., "text": ...} items.
+// Prefixes must be the same as OUTPUT_PREFIXES in utils/consts.py.
+const OUTPUT_PREFIXES = {
+    "user": "\n🙂: ",
+    "assistant": "🤖: ",
+};
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    ui: {
+        renderOutputs: function (outputs) {
+            if (!outputs) {
+                return [];
+            }
+
+            return outputs.map(function (output) {
+                return {
+                    type: "Markdown",
+                    namespace: "dash_core_components",
+                    props: {
+                        children: OUTPUT_PREFIXES[output.role] + output.text,
+                        // allows for LaTeX formatting in responses of AI
+                        mathjax: output.role === "assistant",
+                        // keep white space and breaks, wrap
+                        style: {"white-space": "pre-wrap"},
+                    },
+                };
+            });
+        },
+    },
+});
@@ -0,0 +1,69 @@
+// Upload of a PDF file directly to the server (route /upload) as multipart/form-data, instead of encoding it
+// into a base64 data URL in the browser. Id of the stored file is put into the 'pdf-upload' store.
+(function () {
+    const UPLOAD_ZONE_ID = "upload-pdf";
+
+    function inUploadZone(event) {
+        return event.target.closest && event.target.closest("#" + UPLOAD_ZONE_ID) !== null;
+    }
+
+    function uploadPdf(file) {
+        const formData = new FormData();
+        formData.append("pdf", file);
+
+        window.dash_clientside.set_props(UPLOAD_ZONE_ID, {children: "Uploading " + file.name + " ..."});
+
+        fetch("upload", {method: "POST", body: formData})
+            .then(function (response) {
+                return response.text().then(function (text) {
+                    if (!response.ok) {
+                        // e.g. 415 for a file which is not PDF, 413 for a too large file
+                        throw new Error(text || (response.status + " " + response.statusText));
+                    }
+                    return text;
+                });
+            })
+            .then(function (uid) {
+                window.dash_clientside.set_props("pdf-upload", {data: {uid: uid, filename: file.name}});
+            })
+            .catch(function (error) {
+                window.dash_clientside.set_props(UPLOAD_ZONE_ID, {
+                    children: "Upload of " + file.name + " failed: " + error.message,
+                });
+            });
+    }
+
+    function selectPdf() {
+        const input = document.createElement("input");
+        input.type = "file";
+        input.accept = ".pdf,application/pdf";
+        input.addEventListener("change", function () {
+            if (input.files.length > 0) {
+                uploadPdf(input.files[0]);
+            }
+        });
+        input.click();
+    }
+
+    // the upload zone is rendered by Dash after the page loads, so the events are handled on the document
+    document.addEventListener("click", function (event) {
+        if (inUploadZone(event)) {
+            selectPdf();
+        }
+    });
+
+    document.addEventListener("dragover", function (event) {
+        if (inUploadZone(event)) {
+            event.preventDefault();
+        }
+    });
+
+    document.addEventListener("drop", function (event) {
+        if (inUploadZone(event)) {
+            event.preventDefault();
+            if (event.dataTransfer.files.length > 0) {
+                uploadPdf(event.dataTransfer.files[0]);
+            }
+        }
+    });
+})();
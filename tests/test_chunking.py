@@ -0,0 +1,143 @@
+import random
+import re
+import unittest
+from unittest import mock
+
+import utils.openai_mgmt as openai_mgmt
+import utils.text_extract_summarize as tes
+
+
+def greedy_pack(sentences, sentences_tokens, tokens_limit, current_chunk, current_chunk_tokens):
+    """
+    Reference implementation of _pack_sentences - the sentence by sentence greedy loop it replaced.
+    """
+    chunks = []
+    current_chunk = list(current_chunk)
+    for sentence, sentence_tokens in zip(sentences, sentences_tokens):
+        if current_chunk_tokens + sentence_tokens > tokens_limit:
+            chunks.append(" ".join(current_chunk))
+            current_chunk = [sentence]
+            current_chunk_tokens = sentence_tokens
+        else:
+            current_chunk.append(sentence)
+            current_chunk_tokens += sentence_tokens
+    return chunks, current_chunk, current_chunk_tokens
+
+
+class WordSentenceTokenizer:
+    """
+    Offline stand-in for Punkt: a sentence ends with a dot followed by whitespace.
+    """
+
+    def tokenize(self, text):
+        return [sentence for sentence in re.split(r'(?<=\.)\s+', text.strip()) if sentence]
+
+
+def count_words_batch(texts):
+    return [len(text.split()) for text in texts]
+
+
+def split_by_words(text, tokens_limit):
+    words = text.split()
+    return [" ".join(words[i:i + tokens_limit]) for i in range(0, len(words), tokens_limit)]
+
+
+class ByteEncoding:
+    """
+    Stand-in for a tiktoken encoding with one token per UTF-8 byte, so token boundaries fall inside multibyte
+    characters (as they do for many CJK characters and emoji in cl100k_base).
+    """
+
+    def encode(self, text):
+        return list(text.encode('utf-8'))
+
+    def encode_batch(self, texts, num_threads=1):
+        return [self.encode(text) for text in texts]
+
+    def decode_bytes(self, tokens):
+        return bytes(tokens)
+
+
+class PackSentencesTest(unittest.TestCase):
+
+    def test_matches_greedy_loop(self):
+        rnd = random.Random(2)
+        for _ in range(5000):
+            tokens_limit = rnd.randint(1, 30)
+            num_sentences = rnd.randint(0, 40)
+            sentences_tokens = [rnd.randint(1, tokens_limit) for _ in range(num_sentences)]
+            sentences = [f's{i}' for i in range(num_sentences)]
+            current_chunk_tokens = rnd.randint(0, tokens_limit)
+            current_chunk = [f'c{i}' for i in range(rnd.randint(1, 3))] if current_chunk_tokens else []
+
+            expected = greedy_pack(sentences, sentences_tokens, tokens_limit, current_chunk, current_chunk_tokens)
+            result = tes._pack_sentences(sentences, sentences_tokens, tokens_limit,
+                                         list(current_chunk), current_chunk_tokens)
+            self.assertEqual(result, expected, (tokens_limit, sentences_tokens, current_chunk_tokens))
+
+    def test_empty_sentences_keep_current_chunk(self):
+        self.assertEqual(tes._pack_sentences([], [], 10, ['a'], 3), ([], ['a'], 3))
+
+    def test_rejects_too_long_sentence(self):
+        with self.assertRaises(ValueError):
+            tes._pack_sentences(['long'], [11], 10, [], 0)
+
+
+@mock.patch.object(tes, 'split_by_tokens', split_by_words)
+@mock.patch.object(tes, 'count_tokens_batch', count_words_batch)
+@mock.patch.object(tes, '_get_sentence_tokenizer', WordSentenceTokenizer)
+class IterChunksTest(unittest.TestCase):
+
+    def test_sentence_continues_on_next_page(self):
+        pages = ['One two. Three fo', 'ur five. Six.']
+        self.assertEqual(list(tes.iter_chunks(pages, 3)), ['One two.', 'Three four five.', 'Six.'])
+
+    def test_empty_input(self):
+        self.assertEqual(list(tes.iter_chunks([], 5)), [])
+        self.assertEqual(list(tes.iter_chunks(['', '  '], 5)), [])
+
+    def test_keeps_text_and_limit(self):
+        rnd = random.Random(1)
+        words = ['alpha', 'beta', 'gamma', 'delta']
+        for _ in range(300):
+            text = ' '.join(rnd.choice(words) + ('.' if rnd.random() < 0.15 else '')
+                            for _ in range(rnd.randint(0, 300)))
+            cuts = sorted(rnd.sample(range(len(text) + 1), k=min(len(text) + 1, rnd.randint(0, 8))))
+            pages = [text[start:stop] for start, stop in zip([0] + cuts, cuts + [len(text)])]
+            tokens_limit = rnd.randint(5, 40)
+
+            chunks = list(tes.iter_chunks(pages, tokens_limit))
+
+            self.assertEqual(' '.join(chunks).split(), text.split(), pages)
+            for chunk in chunks:
+                self.assertTrue(chunk.strip())
+                self.assertLessEqual(len(chunk.split()), tokens_limit, chunk)
+
+
+@mock.patch.object(openai_mgmt, '_get_encoding', lambda encoding_name: ByteEncoding())
+class SplitByTokensTest(unittest.TestCase):
+
+    def test_parts_are_cut_between_characters(self):
+        text = '日本語のテキストは句点で終わる文が長い。😀 émoji ok'
+        for tokens_limit in range(1, 12):
+            parts = openai_mgmt.split_by_tokens(text, tokens_limit)
+            self.assertEqual(''.join(parts), text, tokens_limit)
+            self.assertNotIn('\ufffd', ''.join(parts))
+            for part in parts:
+                # at most one character (max 4 bytes) more than the limit
+                self.assertLessEqual(len(part.encode('utf-8')), max(tokens_limit, 4) + 3, (tokens_limit, part))
+
+    @mock.patch.object(tes, '_get_sentence_tokenizer', WordSentenceTokenizer)
+    def test_long_non_ascii_sentence_is_split_into_valid_parts(self):
+        # CJK text without a dot followed by whitespace is one long "sentence"
+        sentence = '吾輩は猫である。名前はまだ無い。' * 20
+        sentences, sentences_tokens = tes.split_into_sentences_with_tokens(sentence, 50)
+
+        self.assertGreater(len(sentences), 1)
+        self.assertEqual(''.join(sentences), sentence)
+        self.assertEqual(sentences_tokens, [len(part.encode('utf-8')) for part in sentences])
+        self.assertTrue(all(tokens <= 50 for tokens in sentences_tokens))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import asyncio
+import types
+import unittest
+from unittest import mock
+
+import utils.openai_mgmt as openai_mgmt
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        # fake clock, which is moved forward by (not really) sleeping
+        self.now = 0.0
+        clock = types.SimpleNamespace(monotonic=lambda: self.now)
+        time_patch = mock.patch.object(openai_mgmt, 'time', clock)
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+
+    async def _sleep(self, seconds):
+        self.now += seconds
+
+    def _run(self, coro):
+        with mock.patch('asyncio.sleep', self._sleep):
+            asyncio.run(coro)
+
+    def test_waits_for_tokens_to_refill(self):
+        async def scenario():
+            rate_limiter = openai_mgmt.RateLimiter(max_requests_per_minute=60, max_tokens_per_minute=100)
+            await rate_limiter.acquire(100)
+            self.assertEqual(self.now, 0)
+            await rate_limiter.acquire(50)  # 50 tokens refill in 30 seconds
+
+        self._run(scenario())
+        self.assertAlmostEqual(self.now, 30)
+
+    def test_waits_for_requests_to_refill(self):
+        async def scenario():
+            rate_limiter = openai_mgmt.RateLimiter(max_requests_per_minute=2, max_tokens_per_minute=1000)
+            for _ in range(3):
+                await rate_limiter.acquire(1)
+
+        self._run(scenario())
+        self.assertAlmostEqual(self.now, 30)
+
+    def test_request_larger_than_bucket_does_not_wait_forever(self):
+        async def scenario():
+            rate_limiter = openai_mgmt.RateLimiter(max_requests_per_minute=60, max_tokens_per_minute=100)
+            await rate_limiter.acquire(1000)
+
+        self._run(scenario())
+        self.assertEqual(self.now, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
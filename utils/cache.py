@@ -0,0 +1,4 @@
+import diskcache
+
+# Disk cache shared by the app - background callbacks (Dash's DiskcacheManager) and cached OpenAI completions
+cache = diskcache.Cache("./cache")
@@ -1,6 +1,6 @@
 # Following lists need to have double quotes around each item. Single quotes will not work in Dash Dropdown component
 
-AI_ROLE_OPTIONS_EN = [
+AI_ROLE_OPTIONS_EN = (
     "helpful general assistant",
     "expert in physics, including quantum physics",
     "funny and helpful teacher",
@@ -8,10 +8,16 @@ AI_ROLE_OPTIONS_EN = [
     "kind and helpful primary school teacher, explaining in terms that a child can understand",
     "code assistant and code reviewer",
     "food recipes expert",
-]
+)
 
 AI_SUMMARIZATION_TYPE = {
     "TEXT_SUMMARIZATION": "Text summarization",
     "BULLET_POINTS": "Bullet points",
     "FOCUS_QUESTION": "Focus on question",
 }
+
+# Prefixes of outputs by role when outputs are shown (assets/render.js) or downloaded
+OUTPUT_PREFIXES = {
+    "user": "\n🙂: ",
+    "assistant": "🤖: ",
+}
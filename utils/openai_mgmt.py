@@ -1,5 +1,137 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+import aiohttp
 import openai
 import tiktoken
+from utils.cache import cache
+
+# Batch API - interval of checking if a batch is finished (seconds) and statuses of a finished batch
+BATCH_POLL_INTERVAL = 30
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Completions are cached only for requests with randomness up to this value (their completions are nearly
+# deterministic), unless the caller asks for caching (summaries) or caching of all completions is forced
+# with the FORCE_CACHE environment variable
+CACHE_MAX_RANDOMNESS = 0.2
+# cached completions expire after a week (seconds)
+CACHE_EXPIRE = 7 * 24 * 60 * 60
+
+# HTTP errors with a more specific OpenAI exception type, anything else is raised as a generic APIError
+OPENAI_HTTP_ERRORS = {
+    401: openai.error.AuthenticationError,
+    429: openai.error.RateLimitError,
+}
+
+# Event loop running in a background thread of the process, it owns the HTTP session shared by all completion
+# requests. Keeping both alive between calls lets the session reuse open connections (keep-alive), so TCP and TLS
+# handshakes are not repeated for every request.
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+_session = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Returns the background event loop of this process, starts it on first use."""
+    global _loop, _loop_pid, _session
+    with _loop_lock:
+        # a forked process (e.g. background callback) inherits the loop object, but not its thread
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            _session = None
+            threading.Thread(target=_loop.run_forever, name='openai-event-loop', daemon=True).start()
+        return _loop
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Returns the shared HTTP session, creates a new one if there is none or the previous one was closed."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=64,
+                                                                        keepalive_timeout=60,
+                                                                        ttl_dns_cache=300))
+    return _session
+
+
+async def close_session() -> None:
+    """Closes the shared HTTP session."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+@atexit.register
+def _close_session_at_exit() -> None:
+    if _loop is not None and _loop_pid == os.getpid() and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(close_session(), _loop).result(timeout=5)
+
+
+def run_async(coro):
+    """
+    Run a coroutine from synchronous code (e.g. Dash callback) on the background event loop and wait for its result.
+    param: coro: coroutine to run
+    return: result of the coroutine
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+class RateLimiter:
+    """
+    Token bucket throttle for OpenAI API calls. Both requests per minute and tokens per minute are limited,
+    the buckets refill continuously up to their per-minute capacity.
+    """
+
+    def __init__(self, max_requests_per_minute: int, max_tokens_per_minute: int):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_requests = float(max_requests_per_minute)
+        self.available_tokens = float(max_tokens_per_minute)
+        self.last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_update) / 60
+        self.available_requests = min(self.max_requests_per_minute,
+                                      self.available_requests + elapsed_minutes * self.max_requests_per_minute)
+        self.available_tokens = min(self.max_tokens_per_minute,
+                                    self.available_tokens + elapsed_minutes * self.max_tokens_per_minute)
+        self.last_update = now
+
+    async def acquire(self, num_tokens: int) -> None:
+        """
+        Wait until there is capacity for one more request with num_tokens tokens, then take it.
+        param: num_tokens: int (number of tokens the request will consume)
+        """
+        # a request larger than the whole bucket would wait forever
+        num_tokens = min(num_tokens, self.max_tokens_per_minute)
+
+        # the lock makes waiting requests take capacity in the order they arrived
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= num_tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= num_tokens
+                    return
+
+                wait_minutes = max((1 - self.available_requests) / self.max_requests_per_minute,
+                                   (num_tokens - self.available_tokens) / self.max_tokens_per_minute)
+                await asyncio.sleep(wait_minutes * 60)
+
+
+@lru_cache(maxsize=4)
+def _get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    """Returns a tiktoken encoding, loaded only once per encoding name."""
+    return tiktoken.get_encoding(encoding_name)
 
 
 def num_tokens_in_string(text: str, encoding_name: str = "cl100k_base") -> int:
@@ -8,30 +140,246 @@ def num_tokens_in_string(text: str, encoding_name: str = "cl100k_base") -> int:
     param: encoding_name: string (default: "cl100k_base", which is encoding for gpt-4 and gpt-3.5)
     return: int (number of tokens)
     """
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(text))
-    return num_tokens
+    return len(_get_encoding(encoding_name).encode(text))
 
 
-def openai_completion(prompt: list[dict], llm_model: str, random_value: float = 0.8) -> str:
+def count_tokens_batch(texts: list[str], encoding_name: str = "cl100k_base") -> list[int]:
+    """Returns numbers of GPT tokens in a list of text strings, texts are encoded in parallel threads.
+    param: texts: list of strings
+    param: encoding_name: string (default: "cl100k_base", which is encoding for gpt-4 and gpt-3.5)
+    return: list of int (number of tokens of each text)
     """
-    OpenAI text completion API call.
-    param: prompt: string
+    encoded_texts = _get_encoding(encoding_name).encode_batch(texts, num_threads=os.cpu_count() or 1)
+    return [len(tokens) for tokens in encoded_texts]
+
+
+def split_by_tokens(text: str, tokens_limit: int, encoding_name: str = "cl100k_base") -> list[str]:
+    """Splits a text into parts with about tokens_limit GPT tokens each. The text is encoded only once.
+    Parts are cut between characters, a part may have a few tokens more if a cut falls inside a character.
+    param: text: string
+    param: tokens_limit: int (max number of tokens in a part)
+    param: encoding_name: string (default: "cl100k_base", which is encoding for gpt-4 and gpt-3.5)
+    return: list of strings
+    """
+    encoding = _get_encoding(encoding_name)
+    tokens = encoding.encode(text)
+
+    parts = []
+    remaining_bytes = b''
+    for i in range(0, len(tokens), tokens_limit):
+        # a token may be only a part of a multibyte character (CJK, emoji), so the part is cut after the last
+        # complete character and the remaining bytes continue in the next part
+        part_bytes = remaining_bytes + encoding.decode_bytes(tokens[i:i + tokens_limit])
+        cut = _complete_utf8_length(part_bytes)
+        remaining_bytes = part_bytes[cut:]
+        if cut > 0:
+            parts.append(part_bytes[:cut].decode('utf-8'))
+
+    return parts
+
+
+def _complete_utf8_length(data: bytes) -> int:
+    """Returns the length of the longest prefix of UTF-8 bytes which doesn't end inside a character.
+    param: data: bytes
+    return: int
+    """
+    # the last character starts at the last byte which is not a continuation byte (0b10xxxxxx)
+    for back in range(1, min(4, len(data)) + 1):
+        lead_byte = data[-back]
+        if lead_byte & 0xC0 != 0x80:
+            char_length = 1 if lead_byte < 0x80 else 2 if lead_byte < 0xE0 else 3 if lead_byte < 0xF0 else 4
+            return len(data) if back >= char_length else len(data) - back
+    return len(data)
+
+
+async def _openai_request(method: str, path: str, raw: bool = False, **kwargs):
+    """
+    Request to OpenAI REST API over the shared HTTP session.
+    param: method: HTTP method
+    param: path: path of the API endpoint, e.g. "/chat/completions"
+    param: raw: return response body as bytes instead of parsed JSON
+    param: kwargs: arguments of the request, e.g. json or data
+    return: dict (parsed JSON response) or bytes (response body)
+    """
+    # base URL and organization are configured as for the openai client (OPENAI_API_BASE, OPENAI_ORGANIZATION)
+    url = openai.api_base.rstrip("/") + path
+    headers = {"Authorization": f"Bearer {openai.api_key}"}
+    if openai.organization:
+        headers["OpenAI-Organization"] = openai.organization
+
+    try:
+        async with _get_session().request(method, url, headers=headers, **kwargs) as response:
+            response_body = await response.read()
+    except aiohttp.ClientError as e:
+        print(f"OpenAI API request failed: {e}")
+        raise openai.error.APIConnectionError(f"{e}") from e
+
+    if response.status != 200:
+        try:
+            response_json = json.loads(response_body)
+        except ValueError:
+            response_json = {}
+        message = response_json.get("error", {}).get("message") or f"{response.status} {response.reason}"
+        print(f"OpenAI API returned an API error: {message}")
+        error_class = OPENAI_HTTP_ERRORS.get(response.status, openai.error.APIError)
+        raise error_class(message, http_status=response.status, json_body=response_json)
+
+    if raw:
+        return response_body
+
+    try:
+        return json.loads(response_body)
+    except ValueError as e:
+        raise openai.error.APIError(f"Invalid response from OpenAI API: {e}", http_status=response.status) from e
+
+
+def _completion_cache_key(prompt: list[dict], llm_model: str, random_value: float, use_cache: bool) -> str:
+    """
+    Returns the cache key of a completion, or None if the completion is not cached.
+    """
+    if not (use_cache or random_value <= CACHE_MAX_RANDOMNESS or os.getenv("FORCE_CACHE")):
+        return None
+    return 'completion-' + hashlib.sha256(
+        json.dumps({"m": llm_model, "t": random_value, "p": prompt}, sort_keys=True).encode()
+    ).hexdigest()
+
+
+async def openai_completion_async(prompt: list[dict],
+                                  llm_model: str,
+                                  random_value: float = 0.8,
+                                  rate_limiter: RateLimiter = None,
+                                  use_cache: bool = False) -> str:
+    """
+    OpenAI chat completion API call, done directly over HTTP so that multiple calls can run concurrently.
+    param: prompt: list of messages
+    param: llm_model: string
     param: random_value: float
+    param: rate_limiter: RateLimiter shared by concurrent calls (optional)
+    param: use_cache: cache the completion regardless of random_value
     return: string (completion or error message)
     """
+    cache_key = _completion_cache_key(prompt, llm_model, random_value, use_cache)
+    if cache_key is not None:
+        if (cached_completion := cache.get(cache_key)) is not None:
+            print("Completion found in cache.")
+            return cached_completion
+
+    if rate_limiter is not None:
+        await rate_limiter.acquire(sum(num_tokens_in_string(message["content"]) for message in prompt))
+
     print("Sending to OpenAI API - prompt for completion:\n", prompt)
-    try:
-        response = openai.ChatCompletion.create(
-            model=llm_model,
-            messages=prompt,
-            temperature=random_value,
-        )
-    except openai.error.OpenAIError as e:
-        print(f"OpenAI API returned an API error: {e}")
-        raise
-    else:
-        return response['choices'][0]['message']['content']
+    payload = {
+        "model": llm_model,
+        "messages": prompt,
+        "temperature": random_value,
+    }
+    response_json = await _openai_request("POST", "/chat/completions", json=payload)
+
+    if not response_json.get("choices"):
+        message = (response_json.get("error") or {}).get("message") or "Response without choices."
+        print(f"OpenAI API returned an API error: {message}")
+        raise openai.error.APIError(message, json_body=response_json)
+
+    completion = response_json['choices'][0]['message']['content']
+    if cache_key is not None:
+        cache.set(cache_key, completion, expire=CACHE_EXPIRE)
+
+    return completion
+
+
+async def openai_batch_completion(prompts: list[list[dict]],
+                                  llm_model: str,
+                                  random_value: float = 0.8,
+                                  use_cache: bool = False) -> list:
+    """
+    OpenAI chat completions of multiple prompts in one job of the Batch API. A batch costs half the price of
+    single calls, but it takes longer to finish (up to 24 hours). Prompts with a cached completion are not sent.
+    param: prompts: list of prompts (lists of messages)
+    param: llm_model: string
+    param: random_value: float
+    param: use_cache: cache the completions regardless of random_value
+    return: list of completions (string, or OpenAIError if the completion failed), in the order of prompts
+    """
+    cache_keys = [_completion_cache_key(prompt, llm_model, random_value, use_cache) for prompt in prompts]
+    cached_completions = [cache.get(cache_key) if cache_key is not None else None for cache_key in cache_keys]
+    pending = [prompt_pos for prompt_pos, completion in enumerate(cached_completions) if completion is None]
+    print(f"Completions of {len(prompts) - len(pending)} prompts found in cache.")
+    if not pending:
+        return cached_completions
+
+    completions = await _run_batch([prompts[prompt_pos] for prompt_pos in pending], llm_model, random_value)
+
+    for prompt_pos, completion in zip(pending, completions):
+        if isinstance(completion, str) and cache_keys[prompt_pos] is not None:
+            cache.set(cache_keys[prompt_pos], completion, expire=CACHE_EXPIRE)
+        cached_completions[prompt_pos] = completion
+
+    return cached_completions
+
+
+async def _run_batch(prompts: list[list[dict]], llm_model: str, random_value: float) -> list:
+    """
+    Run one job of the Batch API and wait until it is finished.
+    return: list of completions (string, or OpenAIError if the completion failed), in the order of prompts
+    """
+    batch_requests = "\n".join(
+        json.dumps({
+            "custom_id": f"prompt-{prompt_pos}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": llm_model,
+                "messages": prompt,
+                "temperature": random_value,
+            },
+        })
+        for prompt_pos, prompt in enumerate(prompts)
+    )
+
+    form = aiohttp.FormData()
+    form.add_field("purpose", "batch")
+    form.add_field("file", batch_requests.encode(), filename="batch.jsonl", content_type="application/jsonl")
+    input_file = await _openai_request("POST", "/files", data=form)
+
+    batch = await _openai_request("POST", "/batches", json={
+        "input_file_id": input_file["id"],
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h",
+    })
+    print(f"Sent {len(prompts)} prompts to OpenAI API in batch {batch['id']}.")
+
+    while batch["status"] not in BATCH_FINAL_STATUSES:
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await _openai_request("GET", f"/batches/{batch['id']}")
+        print(f"Batch {batch['id']} status: {batch['status']}, "
+              f"completed requests: {batch.get('request_counts', {}).get('completed')}")
+
+    if batch["status"] != "completed":
+        raise openai.error.APIError(f"Batch {batch['id']} is {batch['status']}.")
+
+    completions = {}
+    if batch.get("output_file_id"):
+        output = await _openai_request("GET", f"/files/{batch['output_file_id']}/content", raw=True)
+        for line in output.splitlines():
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                completions[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+
+    return [completions.get(f"prompt-{prompt_pos}",
+                            openai.error.APIError(f"Prompt {prompt_pos + 1} failed in batch {batch['id']}."))
+            for prompt_pos in range(len(prompts))]
+
+
+def openai_completion(prompt: list[dict], llm_model: str, random_value: float = 0.8) -> str:
+    """
+    OpenAI chat completion API call for synchronous code.
+    param: prompt: list of messages
+    param: llm_model: string
+    param: random_value: float
+    return: string (completion or error message)
+    """
+    return run_async(openai_completion_async(prompt, llm_model, random_value))
 
 
 def openai_image(prompt: str) -> str:
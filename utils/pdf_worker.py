@@ -0,0 +1,40 @@
+# Worker process of the parallel text extraction from PDF files.
+# It is run as a script (not through multiprocessing, which imports the main module - the whole app - again
+# in every worker process), so that the worker imports only PyMuPDF.
+#
+# Usage: python pdf_worker.py PDF_PATH
+# Reads page ranges "start stop" (pages [start, stop)) from stdin, one per line, and writes a pickled list
+# of texts of the pages to stdout for each range.
+
+import os
+import pickle
+import sys
+
+
+def extract_pages(doc, start: int, stop: int) -> list[str]:
+    """
+    Extract text from a range of pages [start, stop) of a PDF document (fitz.Document).
+    """
+    return [doc[page].get_text("text") for page in range(start, stop)]
+
+
+def main(pdf_path: str) -> None:
+    # results are written to the original stdout, anything else printed (e.g. warnings of PyMuPDF) goes to stderr
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    import fitz  # PyMuPDF
+
+    with fitz.open(pdf_path) as doc:
+        for line in sys.stdin:
+            start, stop = map(int, line.split())
+            try:
+                pickle.dump(extract_pages(doc, start, stop), results, protocol=pickle.HIGHEST_PROTOCOL)
+                results.flush()
+            except BrokenPipeError:
+                # the parent stopped reading (extraction was cancelled)
+                return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -1,17 +1,67 @@
+import asyncio
 import openai.error
-from pypdf import PdfReader
+import fitz  # PyMuPDF
 import io
+import math
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import re
+from bisect import bisect_right
+from itertools import accumulate
+from functools import lru_cache
+from collections.abc import Iterable, Iterator
+from typing import Union
 import requests
-from bs4 import BeautifulSoup
-from bs4.element import Comment
-from nltk.tokenize import sent_tokenize
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from selectolax.parser import HTMLParser
+from nltk.tokenize import PunktTokenizer
 import nltk
-from utils.openai_mgmt import num_tokens_in_string, openai_completion
+from utils.openai_mgmt import count_tokens_batch, split_by_tokens, openai_completion_async, openai_batch_completion, \
+    RateLimiter
 from utils.consts import AI_SUMMARIZATION_TYPE
 
 
-# Download Punkt Sentence Tokenizer (if not already downloaded)
-nltk.download('punkt')
+# PDFs with up to this many pages are extracted in the current process. Starting a worker process (Python and
+# PyMuPDF) takes ~170 ms, extraction of a page ~1-5 ms, so that worker processes pay off for larger PDFs only.
+PDF_MAX_PAGES_SERIAL = 200
+# min number of pages extracted by a worker process at once
+PDF_MIN_PAGES_PER_WORKER = 10
+# script run by worker processes of the parallel text extraction
+PDF_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdf_worker.py')
+# larger PDFs are extracted by the worker processes in windows of this many pages, so that only
+# a window of texts is extracted ahead of the summarization
+PDF_PAGES_PER_WINDOW = 200
+
+# timeouts of URL downloads (seconds): connecting, waiting for the next part of the content
+DOWNLOAD_TIMEOUT = (3, 30)
+
+# downloaded content (webpage or PDF) is read in parts of this size (bytes) and is limited to max size (bytes)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_DOWNLOAD_SIZE = 50 * 1024 * 1024
+
+# hyphens at end of lines and soft hyphens (U+00AD) in extracted PDF text, removed to connect words
+HYPHENS_PATTERN = re.compile(r'-\n|\u00ad\n?')
+# runs of spaces and tabs in extracted PDF text (layout padding), collapsed into a single space
+SPACES_PATTERN = re.compile(r'[ \t]{2,}|\t')
+
+# max number of text chunks waiting for summarization, keeps memory bounded when the API is slower than extraction
+MAX_QUEUED_CHUNKS = 4
+
+
+# HTTP session for URL downloads, reuses connections and retries transient errors with backoff
+_http_session = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=16,
+                            pool_maxsize=32,
+                            max_retries=Retry(total=3,
+                                              backoff_factor=0.3,
+                                              status_forcelist=(429, 500, 502, 503, 504),
+                                              raise_on_status=False))
+_http_session.mount('https://', _http_adapter)
+_http_session.mount('http://', _http_adapter)
 
 
 def get_content_from_url(url: str) -> tuple[requests.Response, str]:
@@ -19,230 +69,502 @@ def get_content_from_url(url: str) -> tuple[requests.Response, str]:
     Get content (text webpage or PDF) from a URL.
     """
     print(f'Getting content from URL: {url}')
+    # content is streamed, it is read by read_response_content()
+    response = _http_session.get(url,
+                                 headers={
+                                     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3835.0 Safari/537.36',
+                                     'Accept': '*/*',
+                                     'Accept-Encoding': 'gzip, deflate'},
+                                 stream=True,
+                                 timeout=DOWNLOAD_TIMEOUT)
+
     try:
-        response = requests.get(url,
-                                headers={
-                                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3835.0 Safari/537.36',
-                                    'Accept': '*/*'})
         content_type = response.headers['Content-Type'].lower()
         response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        print(f'HTTP error occurred: {e}')
-        raise
-    else:
         # Check that the request was successful (status code 200)
-        if response.status_code == 200:
-            print(f'Received content type: {content_type}')
-            return response, content_type
-        else:
+        if response.status_code != 200:
             raise requests.exceptions.HTTPError(f"{response.status_code}")
+    except Exception as e:
+        # the content is not read, release the connection of the streamed response
+        response.close()
+        print(f'HTTP error occurred: {e}')
+        raise
+
+    print(f'Received content type: {content_type}')
+    return response, content_type
+
+
+def read_response_content(response: requests.Response) -> bytes:
+    """
+    Read the streamed content of a response in parts, max MAX_DOWNLOAD_SIZE bytes.
+    Download is stopped as soon as the content is too large.
+    param: response: response object from get_content_from_url()
+    return: content (decompressed, if the server sent it compressed)
+    """
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None and content_length.isdigit() and int(content_length) > MAX_DOWNLOAD_SIZE:
+        response.close()
+        raise ValueError(f'Content is too large ({int(content_length)} bytes), max size is {MAX_DOWNLOAD_SIZE} bytes.')
+
+    parts = []
+    size = 0
+    with response:
+        try:
+            for part in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                size += len(part)
+                if size > MAX_DOWNLOAD_SIZE:
+                    raise ValueError(f'Content is too large, max size is {MAX_DOWNLOAD_SIZE} bytes.')
+                parts.append(part)
+        except requests.exceptions.RequestException as e:
+            # the content is read after get_content_from_url() returned, so errors of the download
+            # (timeout, broken connection) are reported as invalid content
+            raise ValueError(f'HTTP error: {e}') from e
+
+    return b"".join(parts)
 
 
 def retrieve_pdf_from_response(response: requests.Response, content_type: str) -> io.BytesIO:
     """
     Retrieve PDF content from response.
-    param: response: response object from requests.get()
+    param: response: response object from get_content_from_url()
     param: content_type: content type of the response
     return: PDF file as BytesIO object
     """
     if 'application/pdf' not in content_type:
         raise ValueError(f'Invalid content type: {content_type}, expected PDF.')
     else:
-        return io.BytesIO(response.content)
+        return io.BytesIO(read_response_content(response))
+
+
+def _extract_pages_parallel(pdf_bytes: bytes, num_pages: int) -> Iterator[str]:
+    """
+    Extract text from all pages of a PDF file in worker processes (utils/pdf_worker.py), yield page texts
+    in page order. Each window of pages is split into contiguous ranges, one per worker.
+    """
+    num_workers = min(os.cpu_count() or 1, math.ceil(PDF_PAGES_PER_WINDOW / PDF_MIN_PAGES_PER_WORKER))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # workers read the PDF file from disk, so it is not sent to every worker through a pipe
+        pdf_path = os.path.join(tmp_dir, 'document.pdf')
+        with open(pdf_path, 'wb') as pdf_file:
+            pdf_file.write(pdf_bytes)
+
+        workers = [subprocess.Popen([sys.executable, PDF_WORKER_SCRIPT, pdf_path],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+                   for _ in range(num_workers)]
+        try:
+            for window_start in range(0, num_pages, PDF_PAGES_PER_WINDOW):
+                window_stop = min(window_start + PDF_PAGES_PER_WINDOW, num_pages)
+                pages_per_worker = max(PDF_MIN_PAGES_PER_WORKER, math.ceil((window_stop - window_start) / num_workers))
+                page_ranges = [(start, min(start + pages_per_worker, window_stop))
+                               for start in range(window_start, window_stop, pages_per_worker)]
+
+                for worker, (start, stop) in zip(workers, page_ranges):
+                    worker.stdin.write(f'{start} {stop}\n'.encode())
+                    worker.stdin.flush()
+                for worker, _ in zip(workers, page_ranges):
+                    try:
+                        yield from pickle.load(worker.stdout)
+                    except EOFError:
+                        raise RuntimeError(f'PDF text extraction failed, worker process exited '
+                                           f'with code {worker.wait()}.') from None
+        finally:
+            # closed pipes end the workers, also those still writing texts which are not read anymore
+            for worker in workers:
+                worker.stdin.close()
+                worker.stdout.close()
+            for worker in workers:
+                try:
+                    worker.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+                    worker.wait()
+
+
+def _clean_page_text(page_text: str) -> str:
+    """
+    Remove hyphens at end of lines and soft hyphens (connect words) and collapse runs of spaces in the extracted text.
+    """
+    return SPACES_PATTERN.sub(' ', HYPHENS_PATTERN.sub('', page_text))
 
 
-def extract_text_from_pdf(pdf_file: io.BytesIO) -> tuple[str, int]:
+def iter_pdf_pages(pdf_file: io.BytesIO) -> Iterator[str]:
     """
-    Extract text from a PDF file.
+    Extract text from a PDF file lazily. Yields text of each page, pages of larger PDFs are extracted
+    in parallel worker processes.
     param: pdf_file: PDF file as BytesIO object
-    return: tuple (pdf_text, num_words)
+    return: iterator of page texts
     """
-    reader = PdfReader(pdf_file)
-    pdf_text = ''
+    pdf_bytes = pdf_file.read()
 
-    num_pages = len(reader.pages)
-    for page in range(num_pages):
-        pdf_text += reader.pages[page].extract_text()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        num_pages = doc.page_count
+        print(f'PDF has {num_pages} pages.')
+        if num_pages <= PDF_MAX_PAGES_SERIAL or (os.cpu_count() or 1) < 2:
+            yield from (_clean_page_text(page.get_text("text")) for page in doc)
+            return
 
-    # remove hyphens at end of lines and connect words
-    pdf_text = pdf_text.replace('-\n', '')
-    # # remove newlines
-    # pdf_text = pdf_text.replace('\n', ' ')
+    yield from (_clean_page_text(pages_text) for pages_text in _extract_pages_parallel(pdf_bytes, num_pages))
 
-    num_words = len(nltk.word_tokenize(pdf_text))
 
-    print(f'PDF has {num_words} words.')
-    return pdf_text, num_words
+class WordCountingPages:
+    """
+    Iterable over page texts, which counts words of the pages read so far.
+    Allows to count words of a PDF file while it is being streamed into summarization.
+    """
+
+    def __init__(self, pages: Iterable[str]):
+        self.pages = pages
+        self.num_words = 0
+
+    def __iter__(self) -> Iterator[str]:
+        for page_text in self.pages:
+            self.num_words += len(page_text.split())
+            yield page_text
+
+
+_TEXT_OPTION = 'with capturing main points and key details from'
+_BULLET_OPTION = 'with capturing main points and key details in form of bullets from'
+
+# templates of user prompts for summarization, by (summarization type, text has multiple chunks)
+PROMPT_TEMPLATES = {
+    (AI_SUMMARIZATION_TYPE["TEXT_SUMMARIZATION"], True):
+        f"Please summarize {_TEXT_OPTION} the following {{chunk_pos}}. part of the larger text "
+        "in {short_size} words: {chunk}",
+    (AI_SUMMARIZATION_TYPE["TEXT_SUMMARIZATION"], False):
+        f"Please summarize {_TEXT_OPTION} the following text in {{short_size}} words: {{chunk}}",
+    (AI_SUMMARIZATION_TYPE["BULLET_POINTS"], True):
+        f"Please summarize {_BULLET_OPTION} the following {{chunk_pos}}. part of the larger text "
+        "in {short_size} words: {chunk}",
+    (AI_SUMMARIZATION_TYPE["BULLET_POINTS"], False):
+        f"Please summarize {_BULLET_OPTION} the following text in {{short_size}} words: {{chunk}}",
+    (AI_SUMMARIZATION_TYPE["FOCUS_QUESTION"], True):
+        "Please analyze the {chunk_pos}. part of the larger text and provide a summary in {short_size} "
+        "words focusing on the question: `{question}`. This part of the text is: {chunk}",
+    (AI_SUMMARIZATION_TYPE["FOCUS_QUESTION"], False):
+        "Please analyze the following text and provide a summary in {short_size} words focusing "
+        "on the question: `{question}`. The text is: {chunk}",
+}
+
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": ("You are a summarization expert. Your summary should be accurate and objective. "
+                "Add headings and subheadings. Use markdown for formatting."),
+}
+
+
+@lru_cache(maxsize=1)
+def _get_sentence_tokenizer() -> PunktTokenizer:
+    """
+    Returns the English Punkt sentence tokenizer, loaded only once. Punkt data is downloaded on first use
+    (if not already downloaded), not on import, which would slow down the start of every process.
+    """
+    try:
+        nltk.data.find('tokenizers/punkt_tab/english/')
+    except LookupError:
+        nltk.download('punkt_tab', quiet=True)
+    return PunktTokenizer('english')
 
 
-def split_into_sentences(text: str, tokens_limit: int) -> list[str]:
+def split_into_sentences_with_tokens(text: str, tokens_limit: int) -> tuple[list[str], list[int]]:
     """
-    Split a text into sentences.
+    Split a text into sentences. Sentences longer than tokens_limit tokens are split into parts.
+    Number of tokens of each sentence is returned as well, so that it doesn't need to be counted again.
+    return: tuple (sentences, sentences_tokens)
     """
-    list_of_sentences = sent_tokenize(text)
+    list_of_sentences = _get_sentence_tokenizer().tokenize(text)
     resulting_list = []
-    chars_limit = int(tokens_limit * 4 * 0.9)  # 4 is an average number of characters per token, we take 90% for safety
-
-    for sentence in list_of_sentences:
-        if len(sentence) > chars_limit:
-            for i in range(0, len(sentence), chars_limit):
-                if i + chars_limit <= len(sentence):
-                    resulting_list.append(sentence[i:i + chars_limit])
-                else:
-                    resulting_list.append(sentence[i:])
+    resulting_tokens = []
+    part_tokens_limit = int(tokens_limit * 0.9)  # we take 90% for safety, a part may re-encode slightly differently
+
+    for sentence, sentence_tokens in zip(list_of_sentences, count_tokens_batch(list_of_sentences)):
+        if sentence_tokens > tokens_limit:
+            parts = split_by_tokens(sentence, part_tokens_limit)
+            resulting_list.extend(parts)
+            resulting_tokens.extend(count_tokens_batch(parts))
         else:
             resulting_list.append(sentence)
+            resulting_tokens.append(sentence_tokens)
 
-    return resulting_list
+    return resulting_list, resulting_tokens
 
 
-def split_into_chunks(sentences: list[str], tokens_limit: int):
+def _pack_sentences(sentences: list[str],
+                    sentences_tokens: list[int],
+                    tokens_limit: int,
+                    current_chunk: list[str],
+                    current_chunk_tokens: int) -> tuple[list[str], list[str], int]:
     """
-    Split a list of sentences into chunks of text. Each chunk can have max tokens_limit tokens.
+    Pack sentences into chunks of max tokens_limit tokens, continuing the current (not yet complete) chunk.
     Sentences must not be split between succeeding chunks so that the summarization is correct.
+    Chunk boundaries are found by bisection in cumulative sums of the sentence tokens, not sentence by sentence.
+    return: tuple (complete chunks, sentences of the current chunk, tokens of the current chunk)
     """
+    if not sentences:
+        return [], current_chunk, current_chunk_tokens
+
+    max_sentence_tokens = max(sentences_tokens)
+    if max_sentence_tokens > tokens_limit:
+        raise ValueError(f'Sentence with {max_sentence_tokens} tokens exceeds the limit of {tokens_limit} tokens.')
+
+    # tokens_bounds[i] is the number of tokens of the first i sentences
+    tokens_bounds = list(accumulate(sentences_tokens, initial=0))
+    num_sentences = len(sentences)
+
+    # fill up the current chunk first
+    chunk_end = bisect_right(tokens_bounds, tokens_limit - current_chunk_tokens) - 1
+    current_chunk = current_chunk + sentences[:chunk_end]
+    current_chunk_tokens += tokens_bounds[chunk_end]
+
     chunks = []
-    current_chunk = ''
+    chunk_start = chunk_end
+    while chunk_start < num_sentences:
+        chunks.append(" ".join(current_chunk))
+        chunk_end = bisect_right(tokens_bounds, tokens_bounds[chunk_start] + tokens_limit, lo=chunk_start + 1) - 1
+        current_chunk = sentences[chunk_start:chunk_end]
+        current_chunk_tokens = tokens_bounds[chunk_end] - tokens_bounds[chunk_start]
+        chunk_start = chunk_end
+
+    return chunks, current_chunk, current_chunk_tokens
+
+
+def iter_chunks(texts: Iterable[str], tokens_limit: int) -> Iterator[str]:
+    """
+    Split a stream of texts (e.g. pages of a document) into chunks of text. Each chunk can have max tokens_limit
+    tokens and consists of whole sentences. Each text is split into sentences once, only its last sentence
+    (that may continue in the next text) is carried over and split again together with the next text.
+    """
+    carry = ''  # last, possibly incomplete sentence of the previous texts
+    current_chunk = []
     current_chunk_tokens = 0
 
-    for sentence in sentences:
-        sentence_tokens = num_tokens_in_string(sentence)
+    for text in texts:
+        text = carry + text
+        sentences, sentences_tokens = split_into_sentences_with_tokens(text, tokens_limit)
+        # whitespace at the end of the text is kept, so that the carried sentence isn't glued to the next text
+        carry = sentences.pop() + text[len(text.rstrip()):] if sentences else ''
+        del sentences_tokens[-1:]
 
-        if sentence_tokens > tokens_limit:
-            raise ValueError(f'Sentence with {sentence_tokens} tokens exceeds the limit of {tokens_limit} tokens.')
+        chunks, current_chunk, current_chunk_tokens = _pack_sentences(sentences, sentences_tokens, tokens_limit,
+                                                                      current_chunk, current_chunk_tokens)
+        yield from chunks
 
-        if current_chunk_tokens + sentence_tokens > tokens_limit:
-            chunks.append(current_chunk)
-            current_chunk = sentence
-            current_chunk_tokens = sentence_tokens
-        else:
-            current_chunk += ' ' + sentence
-            current_chunk_tokens += sentence_tokens
+    if carry:
+        sentences, sentences_tokens = split_into_sentences_with_tokens(carry, tokens_limit)
+        chunks, current_chunk, _ = _pack_sentences(sentences, sentences_tokens, tokens_limit,
+                                                   current_chunk, current_chunk_tokens)
+        yield from chunks
 
     if current_chunk:
-        chunks.append(current_chunk)
-
-    return chunks
+        yield " ".join(current_chunk)
 
 
-def summarize_chunk(num_chunks: int,
-                    chunk_pos: int,
-                    chunk: str,
-                    summarize_type: str,
-                    question: str,
-                    llm_model: str,
-                    length_percentage: int,
-                    randomness: float) -> str:
+def get_summarization_prompt(multiple_chunks: bool,
+                             chunk_pos: int,
+                             chunk: str,
+                             summarize_type: str,
+                             question: str,
+                             length_percentage: int) -> list[dict]:
     """
-    Summarize a chunk of text with a GPT model.
+    Make a GPT prompt for summarization of a chunk of text.
     """
-    num_of_words = len(nltk.word_tokenize(chunk))
+    num_of_words = len(chunk.split())
     short_size = int(num_of_words * length_percentage / 100)
-    user_prompt = ''
-    bullet_option = ''
-
     print('-' * 80)
     print(f'Summarizing chunk {chunk_pos} of size {num_of_words} words to max {short_size} words...\n')
     # print(f'Chunk:\n{chunk}')
 
-    if summarize_type == AI_SUMMARIZATION_TYPE["BULLET_POINTS"]:  # 'Bullet points':
-        bullet_option = 'with capturing main points and key details in form of bullets from'
-    elif summarize_type == AI_SUMMARIZATION_TYPE["TEXT_SUMMARIZATION"]:  # 'Text summarization':
-        bullet_option = 'with capturing main points and key details from'
-
-    if summarize_type == AI_SUMMARIZATION_TYPE["TEXT_SUMMARIZATION"] or \
-            summarize_type == AI_SUMMARIZATION_TYPE["BULLET_POINTS"]:
-        user_prompt = (f"Please summarize {bullet_option} the following {chunk_pos}. part of the larger text "
-                       f"in {short_size} words: "
-                       f"{chunk}"
-                       ) if num_chunks > 1 else (
-            f"Please summarize {bullet_option} the following text in {short_size} words: "
-            f"{chunk}"
-        )
-    elif summarize_type == AI_SUMMARIZATION_TYPE["FOCUS_QUESTION"]:
-        user_prompt = (
-            f"Please analyze the {chunk_pos}. part of the larger text and provide a summary in {short_size} "
-            f"words focusing on the question: `{question}`. This part of the text is: "
-            f"{chunk}"
-            ) if num_chunks > 1 else (
-            f"Please analyze the following text and provide a summary in {short_size} words focusing "
-            f"on the question: `{question}`. The text is: "
-            f"{chunk}"
-        )
-
-    system_prompt = ("You are a summarization expert. Your summary should be accurate and objective. "
-                     "Add headings and subheadings. Use markdown for formatting.")
+    user_prompt = PROMPT_TEMPLATES.get((summarize_type, multiple_chunks), '').format(chunk_pos=chunk_pos,
+                                                                                   short_size=short_size,
+                                                                                   question=question,
+                                                                                   chunk=chunk)
 
     gpt_prompt = [
-        {
-            "role": "system",
-            "content": system_prompt,
-        },
+        SYSTEM_MESSAGE,
         {
             "role": "user",
             "content": user_prompt,
         }
     ]
 
+    return gpt_prompt
+
+
+async def summarize_chunk(multiple_chunks: bool,
+                          chunk_pos: int,
+                          chunk: str,
+                          summarize_type: str,
+                          question: str,
+                          llm_model: str,
+                          length_percentage: int,
+                          randomness: float,
+                          rate_limiter: RateLimiter = None) -> str:
+    """
+    Summarize a chunk of text with a GPT model.
+    """
+    gpt_prompt = get_summarization_prompt(multiple_chunks=multiple_chunks,
+                                          chunk_pos=chunk_pos,
+                                          chunk=chunk,
+                                          summarize_type=summarize_type,
+                                          question=question,
+                                          length_percentage=length_percentage)
+
     try:
-        summarization = openai_completion(gpt_prompt, llm_model, randomness)
+        # summaries are cached at any randomness, summarizing the same text again doesn't call the API
+        summarization = await openai_completion_async(gpt_prompt, llm_model, randomness, rate_limiter,
+                                                      use_cache=True)
     except openai.error.OpenAIError as e:
         raise
     else:
         return summarization
 
 
-def process_text(content_text: str,
-                 summarize_type: str,
-                 question: str,
-                 llm_model: str,
-                 tokens_limit: int,
-                 length_percentage: int = 20,
-                 randomness: float = 0.8) -> str:
+async def summarize_chunks_batch(chunks: Iterator[str],
+                                 summarize_type: str,
+                                 question: str,
+                                 llm_model: str,
+                                 length_percentage: int,
+                                 randomness: float) -> dict:
     """
-    Process text to summarize it. Split into whole sentences, then make chunks with whole sentences,
-    then summarize each chunk.
+    Summarize all chunks of text in one job of OpenAI Batch API (cheaper, but slower).
+    return: dict {chunk position: summary or OpenAIError}
     """
-    num_tokens = num_tokens_in_string(content_text)
-    print(f'\nNumber of tokens in the content: {num_tokens}')
+    # making chunks (text extraction, tokenization) is CPU bound, run it outside the event loop
+    chunks = await asyncio.to_thread(list, chunks)
 
-    sentences = split_into_sentences(content_text, tokens_limit)
-
-    try:
-        chunks = split_into_chunks(sentences, tokens_limit)
-    except ValueError as e:
-        raise
-
-    num_chunks = len(chunks)
-
-    summary_pieces = ""
-    for chunk_pos, chunk in enumerate(chunks):
-        try:
-            summarization = summarize_chunk(num_chunks=num_chunks,
+    gpt_prompts = [get_summarization_prompt(multiple_chunks=len(chunks) > 1,
                                             chunk_pos=chunk_pos + 1,
                                             chunk=chunk,
                                             summarize_type=summarize_type,
                                             question=question,
-                                            llm_model=llm_model,
-                                            length_percentage=length_percentage,
-                                            randomness=randomness)
-        except openai.error.OpenAIError as e:
-            raise
-        else:
-            summary_pieces = summary_pieces + '\n\n' + summarization
+                                            length_percentage=length_percentage)
+                   for chunk_pos, chunk in enumerate(chunks)]
+
+    summarizations = await openai_batch_completion(gpt_prompts, llm_model, randomness,
+                                                   use_cache=True) if gpt_prompts else []
+    return {chunk_pos + 1: summarization for chunk_pos, summarization in enumerate(summarizations)}
+
+
+async def summarize_chunks_concurrently(chunks: Iterator[str],
+                                        summarize_type: str,
+                                        question: str,
+                                        llm_model: str,
+                                        length_percentage: int,
+                                        randomness: float,
+                                        max_concurrency: int,
+                                        max_requests_per_minute: int,
+                                        max_tokens_per_minute: int) -> dict:
+    """
+    Summarize chunks of text concurrently while the next chunks are being made.
+    At most max_concurrency chunks are summarized at once, throttled to the API rate limits.
+    return: dict {chunk position: summary or the error of its summarization}
+    """
+    queue = asyncio.Queue(maxsize=MAX_QUEUED_CHUNKS)
+    rate_limiter = RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+    summarizations = {}
+
+    async def summarization_worker():
+        while (queued_chunk := await queue.get()) is not None:
+            chunk_pos, chunk, multiple_chunks = queued_chunk
+            try:
+                summarizations[chunk_pos] = await summarize_chunk(multiple_chunks=multiple_chunks,
+                                                                  chunk_pos=chunk_pos,
+                                                                  chunk=chunk,
+                                                                  summarize_type=summarize_type,
+                                                                  question=question,
+                                                                  llm_model=llm_model,
+                                                                  length_percentage=length_percentage,
+                                                                  randomness=randomness,
+                                                                  rate_limiter=rate_limiter)
+            except Exception as e:
+                summarizations[chunk_pos] = e
+
+    workers = [asyncio.create_task(summarization_worker()) for _ in range(max_concurrency)]
+
+    try:
+        # making chunks (text extraction, tokenization) is CPU bound, run it outside the event loop.
+        # A chunk is queued once the next one is known, to tell the model if it is a part of a larger text.
+        chunk = await asyncio.to_thread(next, chunks, None)
+        chunk_pos = 0
+        while chunk is not None:
+            next_chunk = await asyncio.to_thread(next, chunks, None)
+            chunk_pos += 1
+            await queue.put((chunk_pos, chunk, chunk_pos > 1 or next_chunk is not None))
+            chunk = next_chunk
+    except BaseException:
+        for worker in workers:
+            worker.cancel()
+        raise
 
-    return summary_pieces
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
 
+    return summarizations
 
-def tag_visible(element) -> bool:
+
+async def process_text(content_text: Union[str, Iterable[str]],
+                       summarize_type: str,
+                       question: str,
+                       llm_model: str,
+                       tokens_limit: int,
+                       length_percentage: int = 20,
+                       randomness: float = 0.8,
+                       max_concurrency: int = 8,
+                       max_requests_per_minute: int = 200,
+                       max_tokens_per_minute: int = 40000,
+                       batch_mode: bool = False) -> str:
     """
-    Filter out invisible/irrelevant parts from a webpage text.
+    Process text to summarize it. Split into chunks of whole sentences and summarize the chunks concurrently
+    (at most max_concurrency at once, throttled to the API rate limits).
+    Text can be given as a string or as a stream of texts (e.g. pages of a PDF file), which is split into chunks
+    while the already made chunks are being summarized.
+    In batch mode, all chunks are summarized in one job of OpenAI Batch API, which is cheaper, but slower.
+    A chunk that fails is marked in the summary, an error is raised only if no chunk could be summarized.
     """
-    if element.parent.name in ['style', 'script', 'head', 'title', 'meta', '[document]']:
-        return False
-    if isinstance(element, Comment):
-        return False
-    return True
+    if isinstance(content_text, str):
+        content_text = [content_text]
+
+    chunks = iter_chunks(content_text, tokens_limit)
+
+    if batch_mode:
+        summarizations = await summarize_chunks_batch(chunks=chunks,
+                                                      summarize_type=summarize_type,
+                                                      question=question,
+                                                      llm_model=llm_model,
+                                                      length_percentage=length_percentage,
+                                                      randomness=randomness)
+    else:
+        summarizations = await summarize_chunks_concurrently(chunks=chunks,
+                                                             summarize_type=summarize_type,
+                                                             question=question,
+                                                             llm_model=llm_model,
+                                                             length_percentage=length_percentage,
+                                                             randomness=randomness,
+                                                             max_concurrency=max_concurrency,
+                                                             max_requests_per_minute=max_requests_per_minute,
+                                                             max_tokens_per_minute=max_tokens_per_minute)
+
+    num_chunks = len(summarizations)
+    print(f'\nSummarized {num_chunks} chunks.')
+
+    errors = [summarization for summarization in summarizations.values() if isinstance(summarization, Exception)]
+    for error in errors:
+        if not isinstance(error, openai.error.OpenAIError):
+            raise error
+    if errors and len(errors) == num_chunks:
+        raise errors[0]
+
+    # join summaries in the order of chunks
+    summary_pieces = []
+    for chunk_pos in range(1, num_chunks + 1):
+        summarization = summarizations[chunk_pos]
+        if isinstance(summarization, openai.error.OpenAIError):
+            summarization = f'*Part {chunk_pos} could not be summarized - OpenAI API error: {summarization}*'
+        summary_pieces.append('\n\n' + summarization)
+
+    return "".join(summary_pieces)
 
 
 def page_to_string(response: requests.Response, content_type: str) -> tuple[str, int]:
@@ -254,16 +576,18 @@ def page_to_string(response: requests.Response, content_type: str) -> tuple[str,
     if 'text/html' not in content_type:
         raise ValueError(f'Invalid content type: {content_type}, expected HTML.')
 
-    # Parse the content with BeautifulSoup
-    soup = BeautifulSoup(response.content, 'html.parser')
+    # Parse the content with selectolax (C parser)
+    tree = HTMLParser(read_response_content(response))
 
-    # Remove invisible/irrelevant text parts
-    texts = soup.findAll(text=True)
-    visible_texts = filter(tag_visible, texts)
+    # Remove invisible/irrelevant parts. Head (with title and meta) is skipped by taking the text of body only,
+    # comments are not part of the text.
+    for node in tree.css('script, style, nav, footer'):
+        node.decompose()
 
     # Join the text parts
-    joined_filtered_text = u" ".join(t.strip() for t in visible_texts)
-    num_words = len(nltk.word_tokenize(joined_filtered_text))
+    root = tree.body if tree.body is not None else tree.root
+    joined_filtered_text = root.text(separator=" ", strip=True) if root is not None else ''
+    num_words = len(joined_filtered_text.split())
 
     print(f'Page has {num_words} words.')
     return joined_filtered_text, num_words